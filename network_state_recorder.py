@@ -1,150 +1,138 @@
 """
 This is a Network State Recorder (NSR) that periodically fetches network state data from 
-NDTwin and stores it in JSON files, which are then compressed into ZIP archives for efficient storage,
+NDTwin and stores it in JSON files, which are compressed into ZIP archives while being written for efficient storage,
 and can be used for our Visualizer and Web-GUI to replay network states over time.
 """
 from nornir import InitNornir
 from loguru import logger
 import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import threading
 import time
-from datetime import datetime
-import queue
+from collections import deque
 import os
-from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 import zipfile
 import signal
 import argparse
 import sys
 
-FLOWINFO_URL = "/ndt/get_detected_flow_data"
+NDTWIN_KERNEL = "http://127.0.0.1:8000"
 
-GRAPHINFO_URL = "/ndt/get_graph_data"
+FLOWINFO_PATH = "/ndt/get_detected_flow_data"
+FLOWINFO_URL = NDTWIN_KERNEL + FLOWINFO_PATH
+
+GRAPHINFO_PATH = "/ndt/get_graph_data"
+GRAPHINFO_URL = NDTWIN_KERNEL + GRAPHINFO_PATH
+
+ALIVE_TIMEOUT = 2 # in seconds
 
 REQ_INTERVAL = 1  # in seconds
 STORAGE_INTERVAL = 300 # in seconds
 
+# ZIP archives must stay readable by the Visualizer and Web-GUI, so only the deflate level is tunable
+ZIP_COMPRESSION = zipfile.ZIP_DEFLATED
+COMPRESS_LEVEL = 1 # 1 (fastest) to 9 (smallest)
+
 DIR = "./recorded_info"
+WRITE_BUFFER_SIZE = 1 << 20 # 1 MiB, several ticks are coalesced into one write() syscall
 
 THREADS = []
 
+# per-source SPSC buffers: one request_data thread appends, one write_data thread pops.
+# deque.append/popleft are atomic, so no lock or condition variable is needed per item.
 QUEUES = {}
+QUEUE_SIZE = 600 # max buffered items per source, oldest items are dropped beyond this. Set to 2 storage intervals in start()
+DROP_WARNING_INTERVAL = 60 # while a queue stays full, warn about dropped items only once per this many drops
 
-ZIP_PATH = queue.Queue()
+# one pooled session shared by all pollers, so keep-alive connections are reused between requests
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
+SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
 
 STOP_EVENT = threading.Event()
 
-FLOW_FINAL_EVENT = threading.Event()
-GRAPH_FINAL_EVENT = threading.Event()
+# set by request_data after every append (and by terminate()), wakes write_data as soon as there is work
+DATA_EVENT = threading.Event()
 
-def zipper(file_path:str):
+def set_batch_scheduling():
     """
-    Compress a JSON file into a ZIP archive and remove the original file.
+    Mark the calling thread as a CPU-bound batch job for the Linux scheduler (SCHED_BATCH).
     
-    Args:
-        file_path (str): The path to the JSON file to be compressed.
+    It is only a hint, so it is skipped on platforms without SCHED_BATCH and failures are logged.
     """
-    logger.debug(f"Zipping file: {file_path}...")
-    with zipfile.ZipFile(f"{file_path.replace('.json', '_json')}.zip", 'w', zipfile.ZIP_DEFLATED, compresslevel=4) as zipf:
-        zipf.write(file_path, os.path.basename(file_path))
-    logger.debug(f"Removing original file: {file_path}...")
-    os.remove(file_path)
+    if not hasattr(os, "SCHED_BATCH"):
+        return
+    try:
+        os.sched_setscheduler(0, os.SCHED_BATCH, os.sched_param(0))
+    except OSError as e:
+        logger.warning(f"Fail setting SCHED_BATCH scheduling: {e}")
 
-def zip_json_files():
+def set_cpu_affinity(cpus:list):
     """
-    Background thread function that continuously monitors the ZIP_PATH queue
-    and compresses JSON files in parallel using ProcessPoolExecutor.
+    Pin the calling thread, and every thread it starts afterwards, to the given CPU cores.
     
-    Runs until STOP_EVENT is set, then processes any remaining files in the queue.
+    Args:
+        cpus (list): The CPU core numbers to run on (e.g., [2, 3]).
     """
-    global ZIP_PATH,DIR
-    while not STOP_EVENT.is_set():
-        paths = set()
-        # wait for files to zip
-        
-        while not ZIP_PATH.empty():
-            file_path = ZIP_PATH.get(timeout=REQ_INTERVAL)
-            paths.add(file_path)
-            logger.debug(f"Files to zip: {paths}")
-            ZIP_PATH.task_done()
-        
-        if len(paths) == 0:
-            time.sleep(REQ_INTERVAL)
-            continue
-
-        with ProcessPoolExecutor(max_workers=2) as executor:
-            logger.debug(f"Zipping files in parallel: {paths}...")
-            futures = [executor.submit(zipper, file_path) for file_path in paths]
-
-        for future in futures:
-            try:
-                future.result()
-            except Exception as e:
-                logger.error(f"Error zipping files: {e}")
-
-        logger.success(f"Files: {paths} zipped successfully.")
-
-    logger.info("Zipping last files... ")
-    while not FLOW_FINAL_EVENT.is_set() or not GRAPH_FINAL_EVENT.is_set():
-        logger.debug("Waiting for final files to be ready for zipping...")
-        time.sleep(REQ_INTERVAL)
-    logger.debug("All files are ready fot Zipping... ")
-    
-    paths = set()
-    while not ZIP_PATH.empty():
-        file_path = ZIP_PATH.get(timeout=REQ_INTERVAL)
-        paths.add(file_path)
-        ZIP_PATH.task_done()
-
-    for path in paths:
-        zipper(path)
-
-    logger.info("Zipping Stopped.")
+    if not hasattr(os, "sched_setaffinity"):
+        logger.warning("CPU affinity is not supported on this platform, ignoring cpu_affinity setting.")
+        return
+    try:
+        os.sched_setaffinity(0, cpus)
+    except OSError as e:
+        logger.warning(f"Fail setting CPU affinity to {cpus}: {e}")
 
-def write_data(queue_name):
+def write_data(queue_names):
     """
-    Write data from a named queue to JSON files at regular intervals.
+    Write data from the named queues to compressed JSON files at regular intervals.
     
-    Creates a new JSON file every STORAGE_INTERVAL seconds and writes
-    queued data items to it. Files are then added to ZIP_PATH for compression.
+    A single thread serves every data source: every STORAGE_INTERVAL seconds it
+    creates one new ZIP archive per queue and streams the queued data items into
+    the JSON file inside it, so the data is compressed while it is written.
     
     Args:
-        queue_name (str): The name of the queue to read data from (e.g., 'flowinfo', 'graphinfo').
+        queue_names (list): The names of the queues to read data from (e.g., ['flowinfo', 'graphinfo']).
     """
-    global QUEUES,ZIP_PATH
-    file_name = ""
+    # compression makes this thread CPU-bound but not latency-sensitive
+    set_batch_scheduling()
+    data_queues = {queue_name: QUEUES[queue_name] for queue_name in queue_names}
+    dumps = orjson.dumps
+    ndjson_option = orjson.OPT_APPEND_NEWLINE # each item is serialized as one complete NDJSON line
     while not STOP_EVENT.is_set(): # loop until stop event is set
         start_time = time.time()
-        file_name = f"{DIR}/{datetime.fromtimestamp(start_time).strftime('%Y_%m_%d_%H-%M-%S')}_{queue_name}.json"
-        logger.info(f"Storing data from {queue_name} queue to file: {file_name}...")
-        # initialize empty file
-        with open(file_name,'wb') as f: # open a new JSON file
-            while time.time() - start_time < STORAGE_INTERVAL and not STOP_EVENT.is_set(): # In the interval of STORAGE_INTERVAL, write to same file.
-                while not QUEUES[queue_name].empty() and not STOP_EVENT.is_set(): # while there is data in the queue
-                    item = QUEUES[queue_name].get(timeout = 0.1)
-                    logger.debug(f"Writing item with timestamp {item['timestamp']} to {file_name}...")
-                    logger.trace(f"Item content: {item}")
-                    byte_item = orjson.dumps(item)
-                    f.write(byte_item)
-                    f.write(b"\n")
-                    QUEUES[queue_name].task_done()
-                time.sleep(REQ_INTERVAL-0.1)
-            
-            ZIP_PATH.put(file_name)
-            logger.info(f"Starting to zip stored JSON files : {file_name}...")
-
-    logger.info("Zipping remaining data to file before stopping...")
-    if file_name != "":
-        ZIP_PATH.put(file_name)
-
-    # make sure the last file can be zipped.
-    if queue_name == "flowinfo":
-        FLOW_FINAL_EVENT.set()
-    elif queue_name == "graphinfo":
-        GRAPH_FINAL_EVENT.set()
-
-    logger.info(f"Stopped data writing from {queue_name} queue...")
+        end_time = start_time + STORAGE_INTERVAL
+        file_prefix = time.strftime('%Y_%m_%d_%H-%M-%S', time.localtime(start_time))
+        file_names = {queue_name: f"{DIR}/{file_prefix}_{queue_name}_json.zip" for queue_name in queue_names}
+        with ExitStack() as stack:
+            files = {}
+            for queue_name, file_name in file_names.items():
+                logger.info(f"Storing data from {queue_name} queue to file: {file_name}...")
+                # open a new ZIP archive and stream the JSON file into it
+                fp = stack.enter_context(open(file_name,'wb', buffering=WRITE_BUFFER_SIZE))
+                zipf = stack.enter_context(zipfile.ZipFile(fp, 'w', ZIP_COMPRESSION, compresslevel=COMPRESS_LEVEL))
+                files[queue_name] = stack.enter_context(zipf.open(f"{file_prefix}_{queue_name}.json", 'w', force_zip64=True))
+            while time.time() < end_time and not STOP_EVENT.is_set(): # In the interval of STORAGE_INTERVAL, write to same files.
+                # block until new data arrives or the interval ends; clear before draining so no wake-up is lost
+                DATA_EVENT.wait(timeout=end_time - time.time())
+                DATA_EVENT.clear()
+                for queue_name, f in files.items():
+                    data_queue = data_queues[queue_name]
+                    batch = []
+                    while data_queue: # while there is data in the queue, bounded by QUEUE_SIZE
+                        item = data_queue.popleft()
+                        # pass values as arguments so loguru only formats them when the level is enabled
+                        logger.debug("Writing item with timestamp {} to {}...", item['timestamp'], file_names[queue_name])
+                        logger.trace("Item content: {}", item)
+                        batch.append(dumps(item, option=ndjson_option))
+                    if batch:
+                        # one newline-delimited buffer and a single write per tick
+                        f.write(b"".join(batch))
+
+        logger.success(f"Files: {list(file_names.values())} stored successfully.")
+
+    logger.info(f"Stopped data writing from {', '.join(queue_names)} queues...")
 
 
 def terminate(): 
@@ -155,9 +143,11 @@ def terminate():
     global THREADS
     logger.info("Stopping NSR...")
     STOP_EVENT.set()
+    DATA_EVENT.set()
     for t in THREADS:
         t.join()
     THREADS = []
+    SESSION.close()
     time.sleep(2)
     logger.info("NSR stopped.")    
     exit(0)
@@ -174,42 +164,58 @@ def request_data(url,queue_name, params=None):
         queue_name (str): The name of the queue to store received data.
         params (dict, optional): Query parameters to include in the request. Defaults to None.
     """
-    global QUEUES
+    data_queue = QUEUES[queue_name]
+    dropped = 0
+    queue_full = False
+    get = SESSION.get
+    loads = orjson.loads
     try:
+        # requests are scheduled on a fixed grid of REQ_INTERVAL, so slow responses do not shift later polls
+        next_deadline = time.monotonic()
         while not STOP_EVENT.is_set():
-            sleep_time = time.perf_counter_ns()
-            if queue_name not in QUEUES:
-                QUEUES[queue_name] = queue.Queue()
-            response = requests.get(url, params=params)
+            response = get(url, params=params)
             if response.status_code == 200:
                 # add received data to queue with timestamp in ms
-                current = int(datetime.now().timestamp()*1000)
+                current = time.time_ns() // 1_000_000
                 data = {"timestamp": current}
+                payload = loads(response.content)
                 if queue_name == "flowinfo":
-                    data['flowinfo'] = response.json()
+                    data['flowinfo'] = payload
                 elif queue_name == "graphinfo":
-                    data = {**data, **response.json()}
-                if not response.json():
+                    data = {**data, **payload}
+                if not payload:
                     logger.warning(f"No new data from {url}.")
 
-                logger.trace(f"Received {data} from {url}.")
+                logger.trace("Received {} from {}.", data, url)
 
-                QUEUES[queue_name].put(data)
+                if len(data_queue) == data_queue.maxlen:
+                    # the writer is falling behind, the append below drops the oldest item instead of growing without limit
+                    dropped += 1
+                    if not queue_full or dropped % DROP_WARNING_INTERVAL == 0:
+                        logger.warning(f"{queue_name} queue is full, dropping the oldest item ({dropped} dropped so far).")
+                    queue_full = True
+                elif queue_full:
+                    queue_full = False
+                    logger.info(f"{queue_name} queue recovered ({dropped} dropped so far).")
+                data_queue.append(data)
+                DATA_EVENT.set()
 
             else:
                 response.raise_for_status()
 
-            sleep_time = REQ_INTERVAL - ((time.perf_counter_ns() - sleep_time) / 1e9)
-            logger.trace(f"Next request to {url} in {sleep_time:.2f} seconds.")
-
-            if sleep_time < 0:
-                continue
+            next_deadline += REQ_INTERVAL
+            now = time.monotonic()
+            if next_deadline < now:
+                # the request overran the interval, skip the missed ticks instead of bursting to catch up
+                next_deadline += ((now - next_deadline) // REQ_INTERVAL + 1) * REQ_INTERVAL
+            sleep_time = next_deadline - now
+            logger.trace("Next request to {} in {:.2f} seconds.", url, sleep_time)
 
             if STOP_EVENT.wait(timeout=sleep_time):
                 break  # STOP_EVENT was set, exit loop
 
         logger.info(f"Stopped data request from {url}...")
-    except requests.RequestException as e:
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
         logger.error(f"Error fetching data: {e}")
         return None
 
@@ -221,11 +227,9 @@ def ndtwin_alive()->bool:
         bool: True if the server responds with status code 200, False otherwise.
     """
     try:
-        response = requests.get(FLOWINFO_URL)
-        if response.status_code == 200:
-            return True
-        else:
-            return False
+        # stream=True only reads the status line and headers, the flow data body is never downloaded
+        with SESSION.get(FLOWINFO_URL, timeout=ALIVE_TIMEOUT, stream=True) as response:
+            return response.status_code == 200
     except requests.RequestException as e:
         logger.error(f"Error checking NDTwin server status: {e}")
         return False
@@ -269,26 +273,32 @@ def start():
     connectivity, creates necessary directories, and spawns threads for:
     - Fetching flow info data from NDTwin API
     - Fetching graph info data from NDTwin API  
-    - Writing queued data to JSON files
-    - Compressing stored JSON files into ZIP archives
+    - Writing queued data to JSON files compressed into ZIP archives
     """
-    global THREADS,FLOWINFO_URL,GRAPHINFO_URL,REQ_INTERVAL,STORAGE_INTERVAL
+    global THREADS,FLOWINFO_URL,GRAPHINFO_URL,REQ_INTERVAL,STORAGE_INTERVAL,COMPRESS_LEVEL,QUEUE_SIZE
     config = InitNornir(config_file="NSR.yaml")
     try:
         # config
         if config.inventory.hosts.get("Recorder") is not None:
             display_on_console = config.inventory.hosts["Recorder"].data.get("display_on_console",True)
             logger_config(level=config.inventory.hosts["Recorder"].data.get("log_level","INFO"), display_on_console=display_on_console)
-            ndtwin_kernel = config.inventory.hosts["Recorder"].data.get("ndtwin_kernel","http://127.0.0.1:8000")
-            FLOWINFO_URL = ndtwin_kernel + FLOWINFO_URL
-            GRAPHINFO_URL = ndtwin_kernel + GRAPHINFO_URL
+            ndtwin_kernel = config.inventory.hosts["Recorder"].data.get("ndtwin_kernel",NDTWIN_KERNEL)
+            FLOWINFO_URL = ndtwin_kernel + FLOWINFO_PATH
+            GRAPHINFO_URL = ndtwin_kernel + GRAPHINFO_PATH
             REQ_INTERVAL = config.inventory.hosts["Recorder"].data.get("request_interval",1)
             STORAGE_INTERVAL = config.inventory.hosts["Recorder"].data.get("storage_interval",5) * 60
+            COMPRESS_LEVEL = config.inventory.hosts["Recorder"].data.get("compress_level",COMPRESS_LEVEL)
+            cpu_affinity = config.inventory.hosts["Recorder"].data.get("cpu_affinity",[])
         else:
             logger.error("No Recorder setting found, exiting...")
             return
+
+        # the writer thread only opens the archives later, so reject a bad level before any thread starts
+        if isinstance(COMPRESS_LEVEL, bool) or not isinstance(COMPRESS_LEVEL, int) or not 1 <= COMPRESS_LEVEL <= 9:
+            logger.error(f"Invalid compress_level setting: {COMPRESS_LEVEL!r}, it must be an integer from 1 to 9, exiting...")
+            exit(1)
         
-        logger.info(f"Recorder settings: NDTwin server: {ndtwin_kernel}, Request interval: {REQ_INTERVAL} seconds, Storage interval: {int(STORAGE_INTERVAL/60)} minutes")
+        logger.info(f"Recorder settings: NDTwin server: {ndtwin_kernel}, Request interval: {REQ_INTERVAL} seconds, Storage interval: {int(STORAGE_INTERVAL/60)} minutes, Compress level: {COMPRESS_LEVEL}")
 
         if not ndtwin_alive():
             logger.error("NDTwin server is not reachable, exiting...")
@@ -296,22 +306,28 @@ def start():
 
         os.makedirs(DIR, exist_ok=True)
 
+        if cpu_affinity:
+            # threads inherit the affinity, so pin before starting them
+            logger.info(f"Pinning NSR to CPU cores: {cpu_affinity}")
+            set_cpu_affinity(cpu_affinity)
+
         logger.info("Starting NSR...")
+        # create the queues before any thread uses them, bounded to two storage intervals of data
+        QUEUE_SIZE = max(1, int(STORAGE_INTERVAL * 2 / REQ_INTERVAL))
+        queue_names = ['flowinfo','graphinfo']
+        for queue_name in queue_names:
+            QUEUES[queue_name] = deque(maxlen=QUEUE_SIZE)
+
         # start threads
         flowinfo_thread = threading.Thread(target=request_data, args=(FLOWINFO_URL,'flowinfo'))
-        flowinfo_write_process = threading.Thread(target=write_data, args=('flowinfo',))
-        
-
         graphinfo_thread = threading.Thread(target=request_data, args=(GRAPHINFO_URL,'graphinfo'))
-        graphinfo_write_process = threading.Thread(target=write_data, args=('graphinfo',))
 
-        zip_process = threading.Thread(target=zip_json_files)
+        # one writer thread serves all queues
+        write_process = threading.Thread(target=write_data, args=(queue_names,))
 
         THREADS.append(flowinfo_thread)
-        THREADS.append(flowinfo_write_process)
         THREADS.append(graphinfo_thread)
-        THREADS.append(graphinfo_write_process)
-        THREADS.append(zip_process)
+        THREADS.append(write_process)
 
         for thread in THREADS:
             thread.start()